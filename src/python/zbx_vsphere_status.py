@@ -8,8 +8,52 @@ __version__ = "0.1.0"
 __license__ = "GPL-3.0"
 
 
-import argparse, os, sys, socket, http.client, time, datetime, urllib.parse, re
-from xml.dom import minidom
+import argparse, os, sys, socket, http.client, gzip, time, random, types, string, ssl, functools, threading, json, copy
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # libxml2 based, parses large replies several times faster
+    from lxml import etree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+try:
+    # C implemented, serializes large inventories several times faster
+    import orjson
+except ImportError:
+    orjson = None
+
+def once(function):
+    """Cache the result of a function without arguments, it is built only once even under threads"""
+    lock   = threading.Lock()
+    result = []
+
+    @functools.wraps(function)
+    def wrapper():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(function())
+        return result[0]
+    return wrapper
+
+@once
+def verified_context():
+    """TLS context checking the target certificate, shared by all connections"""
+    context = ssl.create_default_context()
+    context.options |= ssl.OP_NO_COMPRESSION
+    context.set_alpn_protocols(["http/1.1"])
+    return context
+
+@once
+def unverified_context():
+    """TLS context accepting any target certificate, shared by all connections"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode    = ssl.CERT_NONE
+    context.options |= ssl.OP_NO_COMPRESSION
+    context.set_alpn_protocols(["http/1.1"])
+    return context
 
 class TargetConnection:
     port      = 443
@@ -20,28 +64,35 @@ class TargetConnection:
     user      = None
     secret    = None
 
+    logout_on_exit = False
+
     last_error = None
 
     host_cookie_path = "~/tmp/zbx/vsphere"
     host_cookie_file = None
     last_update = None
+    last_rtt_ns = None
+    tls_context = None
+    tls_session = None
     server_cookie = None
 
-    __connection = None
-    __cookie     = None
+    opt_direct = True
+    opt_spaces = "underscore"
 
-    __auth_retry = 0
+    chunk_size  = 65536
 
-    licenses = []
-    systeminfo = {}
-    hostsystems = {}
-    datastores = {}
-    hostdetails = {}
+    # Service content per (hostname, port), shared by all instances of this process
+    systeminfo_cache = {}
+    systeminfo_ttl   = 24 * 3600
+    # Off when the service content itself is reported, it has to be current then
+    systeminfo_cached = True
+    batch_size  = 250
+    max_retries = 4
+    verbose     = 0
 
-    opt_direct = True
-    opt_spaces = "underscore"
+    xmlns_vim = "{urn:vim25}"
 
-    systemfields = [
+    systemfields = (
         ("apiVersion", float),
         ("name", None),
         ("fullName", None),
@@ -57,88 +108,267 @@ class TargetConnection:
         ("vendor", None),
         ("osType", None),
         ("apiType", None),
-    ]
+    )
+    # Without these no request after RetrieveServiceContent can be built
+    systemfields_required = ( "apiType", "propertyCollector", "rootFolder", "sessionManager" )
+    # Read-only tag -> converter lookup, plain strings are passed through str
+    systemfields_map = types.MappingProxyType({ entry: function or str for entry, function in systemfields })
+
+    def __init__(self, hostname, user, secret, logout=False):
+        self.__connection = None
+        self.__bound      = {}
 
-    def __init__(self, hostname, user, secret):
         self.hostname = hostname
         self.user     = user
         self.secret   = secret
+        self.logout_on_exit = logout
+
+        # Results are per target, parallel polls must not share them
+        self.licenses    = []
+        self.systeminfo  = {}
+        self.hostsystems = {}
+        self.datastores  = {}
+        self.hostdetails = {}
+
         self.host_cookie_path = os.path.expanduser(self.host_cookie_path)
-        self.host_cookie_file = "%s/cookie.%s" % (self.host_cookie_path, self.hostname)
+        # An empty cookie path disables the session cache, host_cookie_file stays None then
+        if self.host_cookie_path:
+            self.host_cookie_file = os.path.join(self.host_cookie_path, "cookie." + self.hostname)
 
     def __del__(self):
         self.close()
 
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only a session this connection used is ended
+        if self.logout_on_exit and self.server_cookie:
+            self.logout()
+        self.close()
+
     def connect(self):
         """Initialize connection to target system"""
         try:
-            if self.checkcert:
-                self.__connection = http.client.HTTPSConnection(self.hostname, self.port, timeout=self.timeout)
+            # Kept on the instance, clones resume TLS sessions made with this very context
+            if self.tls_context is None:
+                self.tls_context = verified_context() if self.checkcert else unverified_context()
+            self.__connection = http.client.HTTPSConnection(self.hostname, self.port, timeout=self.timeout, context=self.tls_context)
+            self.__open()
+
+            cached = self.systeminfo_cached and \
+                     (self.systeminfo_cache.get((self.hostname, self.port)) or self.__load_systeminfo())
+            if cached and time.monotonic() - cached[0] < self.systeminfo_ttl:
+                self.systeminfo = dict(cached[1])
+                self.__use_systeminfo()
             else:
-                try:
-                    import ssl
-                    self.__connection = http.client.HTTPSConnection(self.hostname, self.port, timeout=self.timeout, context=ssl._create_unverified_context())
-                except expression as identifier:
-                    raise
-            
-            self.__connection.connect()
-
-            self.retrieve_systeminfo()
+                self.retrieve_systeminfo()
 
             if not self.systeminfo:
                 raise TargetConnection.WebApiException("Unable to retrieve data from Web API")
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            raise TargetConnection.QueryServerException(str(e)) from e
         except:
             self.close()
             raise
     
+    def __open(self):
+        """Open the socket of the connection, resuming an earlier TLS session to the target if there is one"""
+        if not self.tls_session:
+            self.__connection.connect()
+            return
+
+        # As HTTPSConnection.connect(), but the handshake is abbreviated
+        sock = socket.create_connection((self.hostname, self.port), self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__connection.sock = self.tls_context.wrap_socket(sock, server_hostname=self.hostname, session=self.tls_session)
+        except ValueError:
+            # The session does not fit this context, fall back to a full handshake
+            sock.close()
+            self.tls_session = None
+            self.__connection.connect()
+        except:
+            sock.close()
+            raise
+
+    def __keep_tls_session(self):
+        """Remember the TLS session of the open connection for the next ones"""
+        sock = self.__connection and self.__connection.sock
+        if sock and sock.session:
+            self.tls_session = sock.session
+
     def close(self):
         if self.__connection:
             self.__connection.close()
 
+    def clone(self):
+        """Return an unconnected copy sharing the session and service content"""
+        self.__keep_tls_session()
+        other = copy.copy(self)
+        other.__connection = None
+
+        other.licenses    = []
+        other.systeminfo  = dict(self.systeminfo)
+        other.hostsystems = {}
+        other.datastores  = {}
+        other.hostdetails = {}
+        return other
+
+    def retrieve_all(self):
+        """Retrieve hosts, licenses and datastores in parallel
+
+        A single connection cannot carry concurrent requests, so every
+        retrieval runs on its own clone of this connection.
+        """
+        workers = [ self.clone() for i in range(3) ]
+        try:
+            with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+                hosts      = executor.submit(workers[0].retrieve_hostsystems)
+                licenses   = executor.submit(workers[1].retrieve_licenses)
+                datastores = executor.submit(workers[2].retrieve_datastores)
+
+            self.hostsystems = hosts.result().hostsystems
+            self.hostdetails = hosts.result().hostdetails
+            self.licenses    = licenses.result().licenses
+            self.datastores  = datastores.result().datastores
+        finally:
+            for worker in workers:
+                worker.close()
+
+        return self
+
     def retrieve_systeminfo(self):
         """Retrieve basic data, which requires no login"""
         payload = self.__xml_systeminfo
         reply_code, reply_msg, reply_headers, reply_data = self.query_target(payload)
 
-        for entry, function in self.systemfields:
-            element = self.get_pattern("<%(entry)s.*>(.*)</%(entry)s>" % { "entry": entry }, reply_data)
-            if element:
-                self.systeminfo[entry] = function and function(element[0]) or element[0]
+        # Single pass over the reply, picking up every known field by its local tag name
+        systeminfo = {}
+        parser = ET.XMLPullParser(events=("end",))
+        parser.feed(reply_data)
+        for event, element in parser.read_events():
+            entry    = element.tag.rsplit("}", 1)[-1]
+            function = self.systemfields_map.get(entry)
+            # An empty element stays an empty string, numeric fields are left out then
+            text = element.text or ""
+            if function is str or (function and text):
+                systeminfo[entry] = function(text)
+            element.clear()
+        parser.close()
+
+        # A fault or a failed reply must not end up in the caches
+        if reply_code != 200 or not self.__valid_systeminfo(systeminfo):
+            raise TargetConnection.WebApiException("Unable to retrieve service content, reply %s %s" % (reply_code, reply_msg))
+
+        self.systeminfo = systeminfo
+        self.systeminfo_cache[(self.hostname, self.port)] = (time.monotonic(), dict(systeminfo))
+        self.__store_systeminfo()
+        self.__use_systeminfo()
 
-        self.opt_direct = ( self.systeminfo['apiType'] == 'HostAgent' )
-        
         return self
 
-    def retrieve_hostsystems(self):
-        payload = self.__xml_hostsystems
+    def __systeminfo_path(self):
+        """File keeping the service content, keyed by target and port like the in-process cache"""
+        if self.host_cookie_path:
+            return os.path.join(self.host_cookie_path, "systeminfo.%s.%d" % (self.hostname, self.port))
 
-        reply_code, reply_msg, reply_headers, reply_data = self.query_target(self.__xml_hostsystems)
-        elements = self.get_pattern('<obj type="HostSystem">(.*?)</obj>.*?<val xsi:type="xsd:string">(.*?)</val>', reply_data)
-        for hostsystem, name in elements:
-            self.hostsystems[hostsystem] = name
-        
+    def __load_systeminfo(self):
+        """Return the service content stored by an earlier run, if it is fresh enough"""
+        systeminfo_path = self.__systeminfo_path()
+        if not systeminfo_path:
+            return None
+
+        try:
+            with open(systeminfo_path, "rb") as systeminfo_file:
+                age = time.time() - os.fstat(systeminfo_file.fileno()).st_mtime
+                if age >= self.systeminfo_ttl:
+                    return None
+                cached = (time.monotonic() - age, json.load(systeminfo_file))
+        except (OSError, ValueError):
+            return None
+
+        if not self.__valid_systeminfo(cached[1]):
+            return None
+
+        self.systeminfo_cache[(self.hostname, self.port)] = cached
+        return cached
+
+    def __valid_systeminfo(self, systeminfo):
+        """Check that the service content carries every field the requests are built from"""
+        return isinstance(systeminfo, dict) and all(systeminfo.get(entry) for entry in self.systemfields_required)
+
+    def __store_systeminfo(self):
+        """Keep the service content next to the session cookie for the following runs"""
+        systeminfo_path = self.__systeminfo_path()
+        if not systeminfo_path:
+            return
+
+        # Written aside and renamed, a concurrent run never reads a partial file
+        partial_file = "%s.%d" % (systeminfo_path, os.getpid())
+        try:
+            os.makedirs(self.host_cookie_path, exist_ok=True)
+            with open(partial_file, "w") as systeminfo_file:
+                json.dump(self.systeminfo, systeminfo_file)
+            os.replace(partial_file, systeminfo_path)
+        except OSError:
+            pass
+
+    def __use_systeminfo(self):
+        self.opt_direct = ( self.systeminfo['apiType'] == 'HostAgent' )
+
+        # Everything but the token is fixed for this connection now, so the
+        # continuation request for further pages is only glued together
+        self.__continue_pre, self.__continue_post = self.put_in_envelope(
+            self.__xml_continuetoken.safe_substitute(self.systeminfo).encode("utf-8")).split(b"${token}")
+
+        # The other requests take nothing but the system info either, they
+        # are finished once here and sent as they are afterwards
+        payload_params = dict(self.systeminfo, batchSize=self.batch_size)
+        self.__bound = { payload: self.put_in_envelope(payload.safe_substitute(payload_params).encode("utf-8"))
+                         for payload in (self.__xml_licensesused, self.__xml_datastores,
+                                         self.__xml_hostdetails, self.__xml_logout) }
+
+    def retrieve_hostsystems(self):
+        """Retrieve the host systems, their names come along with the host details"""
         self.__hostdetails()
 
         return self
 
     def retrieve_licenses(self):
-        self.licenses = []
-        reply_code, reply_msg, reply_headers, reply_data = self.query_target(self.__xml_licensesused)
-
-        root_node     = minidom.parseString(reply_data)
-        licenses_node = root_node.getElementsByTagName("LicenseManagerLicenseInfo")
-        for license_node in licenses_node:
-            total = license_node.getElementsByTagName("total")[0].firstChild.data
-            if total == "0":
-                continue
-            name  = license_node.getElementsByTagName("name")[0].firstChild.data
-            used  = license_node.getElementsByTagName("used")[0].firstChild.data
-            lic = {
-                'name': name,
-                'used': used,
-                'total': total
-            }
-            self.licenses += [ lic ]
+        # Qualified tag names take the parser's native lookup instead of a path translation per call
+        info_tag  = self.xmlns_vim + "LicenseManagerLicenseInfo"
+        total_tag = self.xmlns_vim + "total"
+        name_tag  = self.xmlns_vim + "name"
+        used_tag  = self.xmlns_vim + "used"
+
+        # Every license is taken while the reply is received and dropped afterwards
+        licenses = []
+        response = self.__post(self.__xml_licensesused)
+        reply    = self.__open_reply(response)
+        self.__check_status(response)
+
+        parser = ET.XMLPullParser(events=("end",))
+        for chunk in iter(lambda: reply.read(self.chunk_size), b""):
+            parser.feed(chunk)
+            for event, license_node in parser.read_events():
+                if license_node.tag != info_tag:
+                    continue
+                # One walk over the children instead of a search per field
+                children = { child.tag: child.text for child in license_node }
+                total    = children.get(total_tag, "0")
+                if total != "0":
+                    licenses.append({
+                        'name': children.get(name_tag),
+                        'used': children.get(used_tag),
+                        'total': total
+                    })
+                license_node.clear()
+        parser.close()
+
+        self.licenses = licenses
         
         return self
 
@@ -146,241 +376,304 @@ class TargetConnection:
         hostsystems_properties = {}
         hostsystems_sensors    = {}
 
-        self.hostdetails = {}
-
-        # Propsets
-        reply_code, reply_msg, reply_headers, reply_data = self.query_target(self.__xml_hostdetails)
-        hostsystems_objects = self.get_pattern('<objects>(.*?)</objects>', reply_data)
-
-        for entry in hostsystems_objects:
-            hostname = self.get_pattern('<obj type="HostSystem">(.*)</obj>', entry[:512])[0]
-            hostsystems_properties[hostname] = {}
-            hostsystems_sensors[hostname]    = {}
-
-            current_propname = ""
-
-            def eval_sensor_info(sensor_propset):
-                sensor_pattern = ""
-                for key in [ "name", "label", "summary", "key", "currentReading",
-                                "unitModifier", "baseUnits", "sensorType" ]:
-                    sensor_pattern += "<%(name)s>(.*?)</%(name)s>.*?" % { "name": key}
-
-                sensor_data =  self.get_pattern(sensor_pattern, sensor_propset)
-                for name, label, summary, key, currentReading, unitModifier, baseUnits, sensorType in sensor_data:
-                    hostsystems_sensors[hostname][name] = { "name": name, "label": label, "summary": summary, "key": key,
-                                                            "currentReading": currentReading, "unitModifier": unitModifier,
-                                                            "baseUnits": baseUnits, "sensorType": sensorType }
-
-            def eval_hardwarestatus_info(sensor_propset):
-                sensor_pattern = ""
-                for key in [ "name", "label", "summary", "key" ]:
-                    sensor_pattern += "<%(name)s>(.*?)</%(name)s>.*?" % { "name": key}
-
-                sensor_data = self.get_pattern(sensor_pattern, sensor_propset)
-                for name, label, summary, key in sensor_data:
-                    hostsystems_sensors[hostname][name] = { "name": name, "label": label, "summary": summary, "key": key }
-
-            def eval_multipath_state(multipath_propset):
-                multipaths = self.get_pattern("<name>(.*?)</name><pathState>(.*?)</pathState>", value)
-                for mp_name, mp_state in multipaths:
-                    hba_details = mp_name.split(":")
-                    hba_name = hba_details[0]
-                    hba_num = int(hba_name.replace("vmhba", ""))
-                    lun_id = hba_details[-1]
-
-                    if hba_num >= 32 and hba_num % 64 < 33:
-                        lun_id = "%s pseudo-logical" % lun_id
-                    elif hba_num >= 32 and hba_num % 64 > 32:
-                        lun_id = "%s logical" % lun_id
-                    else:
-                        lun_id = "%s physical" % lun_id
-                    
-                    hostsystems_properties[hostname].setdefault(current_propname, {}).setdefault(lun_id, {}).setdefault(mp_state, 0)
-                    hostsystems_properties[hostname][current_propname][lun_id].setdefault("adapters", [])
-                    hostsystems_properties[hostname][current_propname][lun_id][mp_state] += 1
-                    hostsystems_properties[hostname][current_propname][lun_id]["adapters"].append(mp_name)
-
-            def eval_propset_block(elements, id_key, propset):
-                pattern = ""
-                for key in elements:
-                    pattern += "<%(name)s>(.*?)</%(name)s>.*?" % { "name": key}
-
-                data = self.get_pattern(pattern, propset)
-                for match_groups in data:
-                    entries = dict(zip(elements, match_groups))
-                    for key, value in entries.items():
-                        hostsystems_properties[hostname].setdefault("%s.%s.%s" % \
-                            (current_propname, key, entries[id_key]), []).append(value)
-
-            def eval_cpu_pkg(cpu_pkg_propset):
-                eval_propset_block( [ "index", "vendor", "hz", "busHz", "description" ], "index", cpu_pkg_propset)
-
-            def eval_pci_device(pci_propset):
-                eval_propset_block( [ "id", "vendorName", "deviceName" ], "id", pci_propset)
-
-            def eval_systeminfo_other(otherinfo_propset):
-                data       = self.get_pattern("<identifierValue>(.*?)</identifierValue>.*?<key>(.*?)</key>", otherinfo_propset)
-                keys_index = {}
-
-                for value, key in data:
-                    idx = 0
-                    if key in keys_index:
-                        keys_index[key] = keys_index[key] + 1
-                        idx = keys_index[key]
-                    hostsystems_properties[hostname]["hardware.systemInfo.otherIdentifyingInfo.%s.%d" % (key, idx)] = [ value ]
-                    keys_index[key] = idx
-
-            eval_functions = {
-                "config.multipathState.path"                                      : eval_multipath_state,
-                "runtime.healthSystemRuntime.systemHealthInfo.numericSensorInfo"  : eval_sensor_info,
-                "runtime.healthSystemRuntime.hardwareStatusInfo.storageStatusInfo": eval_hardwarestatus_info,
-                "runtime.healthSystemRuntime.hardwareStatusInfo.cpuStatusInfo"    : eval_hardwarestatus_info,
-                "runtime.healthSystemRuntime.hardwareStatusInfo.memoryStatusInfo" : eval_hardwarestatus_info,
-                "hardware.cpuPkg"                                                 : eval_cpu_pkg,
-                "hardware.pciDevice"                                              : eval_pci_device,
-                "hardware.systemInfo.otherIdentifyingInfo"                        : eval_systeminfo_other,
-            }
-
-            elements = self.get_pattern('<propSet><name>(.*?)</name><val.*?>(.*?)</val></propSet>', entry)
-            for current_propname, value in elements:
-                if eval_functions.get(current_propname):
-                    eval_functions[current_propname](value)
+        vim       = self.xmlns_vim
+        obj_tag   = vim + "obj"
+        name_tag  = vim + "name"
+        val_tag   = vim + "val"
+
+        def first_texts(element, fields):
+            # Nested fields like healthState/key are taken from the first descendant of that name
+            return [ element.findtext(".//" + vim + field) for field in fields ]
+
+        def eval_sensor_block(fields):
+            def eval_sensors(properties, sensors, propname, value):
+                for sensor in value:
+                    entries = dict(zip(fields, first_texts(sensor, fields)))
+                    sensors[entries["name"]] = entries
+            return eval_sensors
+
+        def eval_multipath_state(properties, sensors, propname, value):
+            for path in value:
+                mp_name  = path.findtext(name_tag)
+                mp_state = path.findtext(vim + "pathState")
+
+                hba_details = mp_name.split(":")
+                hba_name = hba_details[0]
+                hba_num = int(hba_name.replace("vmhba", ""))
+                lun_id = hba_details[-1]
+
+                if hba_num >= 32 and hba_num % 64 < 33:
+                    lun_id = "%s pseudo-logical" % lun_id
+                elif hba_num >= 32 and hba_num % 64 > 32:
+                    lun_id = "%s logical" % lun_id
+                else:
+                    lun_id = "%s physical" % lun_id
+
+                lun = properties.setdefault(propname, {}).setdefault(lun_id, {})
+                lun[mp_state] = lun.get(mp_state, 0) + 1
+                lun.setdefault("adapters", []).append(mp_name)
+
+        def eval_propset_block(fields, id_key):
+            def eval_blocks(properties, sensors, propname, value):
+                for block in value:
+                    entries = dict(zip(fields, first_texts(block, fields)))
+                    for key, text in entries.items():
+                        properties.setdefault("%s.%s.%s" % (propname, key, entries[id_key]), []).append(text)
+            return eval_blocks
+
+        def eval_systeminfo_other(properties, sensors, propname, value):
+            keys_index = {}
+
+            for info in value:
+                text = info.findtext(vim + "identifierValue")
+                key  = info.findtext(".//" + vim + "key")
+                idx  = 0
+                if key in keys_index:
+                    keys_index[key] = keys_index[key] + 1
+                    idx = keys_index[key]
+                properties["hardware.systemInfo.otherIdentifyingInfo.%s.%d" % (key, idx)] = [ text ]
+                keys_index[key] = idx
+
+        eval_hardwarestatus_info = eval_sensor_block(self.__hardwarestatus_fields)
+        eval_functions = {
+            "config.multipathState.path"                                      : eval_multipath_state,
+            "runtime.healthSystemRuntime.systemHealthInfo.numericSensorInfo"  : eval_sensor_block(self.__sensor_fields),
+            "runtime.healthSystemRuntime.hardwareStatusInfo.storageStatusInfo": eval_hardwarestatus_info,
+            "runtime.healthSystemRuntime.hardwareStatusInfo.cpuStatusInfo"    : eval_hardwarestatus_info,
+            "runtime.healthSystemRuntime.hardwareStatusInfo.memoryStatusInfo" : eval_hardwarestatus_info,
+            "hardware.cpuPkg"                                                 : eval_propset_block(self.__cpu_pkg_fields, "index"),
+            "hardware.pciDevice"                                              : eval_propset_block(self.__pci_device_fields, "id"),
+            "hardware.systemInfo.otherIdentifyingInfo"                        : eval_systeminfo_other,
+        }
+
+        # One pass over the streamed <objects>, every property is dispatched by its name
+        for objects in self.query_objects(self.__xml_hostdetails):
+            hostname   = objects.findtext(obj_tag)
+            properties = hostsystems_properties[hostname] = {}
+            sensors    = hostsystems_sensors[hostname]    = {}
+
+            # Names and most plain values repeat on every host, all hosts share one copy of them
+            for propset in objects.iterfind(vim + "propSet"):
+                propname = sys.intern(propset.findtext(name_tag))
+                value    = propset.find(val_tag)
+                function = eval_functions.get(propname)
+                if function:
+                    function(properties, sensors, propname, value)
                 else:
-                    hostsystems_properties[hostname].setdefault(current_propname, []).append(value)
+                    properties.setdefault(propname, []).append(sys.intern(value.text or ""))
 
+        self.hostsystems = {}
+        self.hostdetails = {}
         for hostname, properties in hostsystems_properties.items():
-
+            self.hostsystems[hostname] = properties['name'][0]
             self.hostdetails[properties['name'][0]] = {
                 'properties': properties,
                 #'sensors': hostsystems_sensors[hostname]
             }
 
     def retrieve_datastores(self):
-        self.datastores = {}
-        reply_code, reply_msg, reply_headers, reply_data = self.query_target(self.__xml_datastores)
-        elements = self.get_pattern('<objects><obj type="Datastore">(.*?)</obj>(.*?)</objects>', reply_data)
-        for datastore, content in elements:
-            entries = self.get_pattern('<name>(.*?)</name><val xsi:type.*?>(.*?)</val>', content)
-            self.datastores[datastore] = {}
-            for name, value in entries:
-                self.datastores[datastore][name] = value
+        # Qualified tag names take the parser's native lookup instead of a path translation per call
+        obj_tag     = self.xmlns_vim + "obj"
+        propset_tag = self.xmlns_vim + "propSet"
+        name_tag    = self.xmlns_vim + "name"
+        val_tag     = self.xmlns_vim + "val"
+
+        self.datastores = { objects.findtext(obj_tag):
+                                { propset.findtext(name_tag): propset.findtext(val_tag)
+                                  for propset in objects.iterfind(propset_tag) }
+                            for objects in self.query_objects(self.__xml_datastores) }
+
+        return self
+
+    def continue_request(self, token):
+        """Return the ContinueRetrievePropertiesEx request for a token"""
+        return self.__continue_pre + token + self.__continue_post
 
     def put_in_envelope(self, payload):
-        return '<SOAP-ENV:Envelope xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/" '\
-           'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ZSI="http://www.zolera.com/schemas/ZSI/" '\
-           'xmlns:soapenc="http://schemas.xmlsoap.org/soap/encoding/" xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '\
-           'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'\
-           '<SOAP-ENV:Header></SOAP-ENV:Header><SOAP-ENV:Body xmlns:ns1="urn:vim25">' + payload + '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
-
-    def get_pattern(self, pattern, line):
-        if not line:
-            return []
-        p = re.compile(pattern, re.MULTILINE)
-        return p.findall(line)
-    
+        return self.__envelope_pre + payload + self.__envelope_post
+
+    __xml_escapes = str.maketrans({ "&":  "&amp;",
+                                    ">":  "&gt;",
+                                    "<":  "&lt;",
+                                    "'":  "&apos;",
+                                    "\"": "&quot;" })
+
     def encode_url(self, text):
-        for char, replacement in [ ( "&",  "&amp;"),
-                                ( ">",  "&gt;" ),
-                                ( "<",  "&lt;"),
-                                ( "'",  "&apos;"),
-                                ( "\"", "&quot;") ]:
-            text = text.replace(char, replacement)
-        return text
+        return text.translate(self.__xml_escapes)
 
     def query_target(self, payload, payload_params=None):
+        return self.__read_reply(self.__post(payload, payload_params))
+
+    def __read_reply(self, response):
+        response_data = self.__open_reply(response).read()
+
+        return response.status, response.reason, response.msg, response_data
+
+    def query_objects(self, payload, payload_params=None):
+        """Stream the <objects> elements of a RetrievePropertiesEx reply
+
+        The reply is parsed chunk by chunk while it is received. Every <objects>
+        element is yielded once complete and dropped from the tree afterwards,
+        a <token> in the reply triggers the ContinueRetrievePropertiesEx query
+        for the next page.
+        """
+        objects_tag   = self.xmlns_vim + "objects"
+        returnval_tag = self.xmlns_vim + "returnval"
+        token_tag     = self.xmlns_vim + "token"
+
+        page = 0
+        response = self.__post(payload, payload_params)
+        while response:
+            reply = self.__open_reply(response)
+            self.__check_status(response)
+
+            parser   = ET.XMLPullParser(events=("start", "end"))
+            returnval = None
+            token     = None
+            count     = 0
+
+            for chunk in iter(lambda: reply.read(self.chunk_size), b""):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == "start":
+                        if element.tag == returnval_tag:
+                            returnval = element
+                    elif element.tag == objects_tag:
+                        yield element
+                        returnval.remove(element)
+                        count += 1
+                    elif element.tag == token_tag:
+                        token = element.text
+            parser.close()
+
+            page += 1
+            if self.verbose:
+                sys.stderr.write("%s: page=%d objects=%d more=%s\n" % (self.hostname, page, count, bool(token)))
+
+            response = token and self.__post_soapdata(self.continue_request(token.encode("utf-8")))
+
+    def __post(self, payload, payload_params=None):
+        """Send a SOAP request to the target and return the pending response"""
         if not self.__connection:
             self.connect()
 
+        if not payload_params and payload in self.__bound:
+            return self.__post_soapdata(self.__bound[payload])
+
         if payload_params is None:
             payload_params = {}
 
         # Finalize payload
         payload_params.update(self.systeminfo)
-        soapdata = self.put_in_envelope(payload)
-        soapdata = soapdata % payload_params
-
-        params = {}
-        headers = {}
-
-        def init_headers(soapdata):
-            headers["Content-Length"] = "%d" % len(soapdata)
-            headers["Content-Type"]   = 'text/xml; charset="utf-8"'
-            headers["SOAPAction"]     = "urn:vim25/5.0"
-            headers["User-Agent"]     = "Zbx-vSphere-Status"
-            if self.server_cookie:
-                headers["Cookie"]     = self.server_cookie
-        init_headers(soapdata)
-
-        response_data = []
-
-        time_sent = time.time()
-        self.__connection.request("POST", "/sdk", soapdata, headers)
-
-        def check_not_authenticated(text, retry):
-            if "NotAuthenticatedFault" in str(text):
-                raise TargetConnection.QueryServerException("No longer authenticated")
-            elif '<fault xsi:type="NotAuthenticated">' in str(text):
-                if retry <= 1:
-                    self.logout()
-                    print("Trying logout")
-                else:
-                    raise TargetConnection.QueryServerException("No longer authenticated")
-
-        response = self.__connection.getresponse()
-        response_data.append(response.read())
-
-        retry = 0
-        while retry <= 1:
-            retry += 1
-            check_not_authenticated(response_data[0][:512], retry)
-
-        while True:
-            # Look for a <token>0</token> field.
-            # If it exists not all data was transmitted and we need to start a
-            # ContinueRetrievePropertiesExResponse query...
-            token = re.findall(r"<token>(.*)</token>", response_data[-1][:512].decode("utf-8"))
-            if token:
-                payload_params.update({"token": token[0]})
-                soapdata = self.put_in_envelope(xml_continuetoken) % payload_params
-                init_headers(soapdata)
-                self.__connection.send(soapdata)
-                response = self.__connection.getresponse()
-                response_data.append(response.read())
-                check_not_authenticated(response_data[-1][:512])
-            else:
-                break
-
-        time_response = time.time()
+        payload_params.setdefault("batchSize", self.batch_size)
+        soapdata = self.put_in_envelope(payload.safe_substitute(payload_params).encode("utf-8"))
+
+        return self.__post_soapdata(soapdata)
+
+    def __post_soapdata(self, soapdata):
+        """Send a finished SOAP body to the target and return the pending response"""
+        headers = dict(self.__headers)
+        headers["Content-Length"] = "%d" % len(soapdata)
+        if self.server_cookie:
+            headers["Cookie"]     = self.server_cookie
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                time_sent = time.monotonic_ns()
+                response  = self.__send(soapdata, headers)
+                self.last_rtt_ns = time.monotonic_ns() - time_sent
+            except (OSError, http.client.HTTPException) as e:
+                # Do not leave a half used socket behind
+                self.close()
+                raise TargetConnection.QueryServerException(str(e)) from e
+
+            if response.status != 503 or attempt == self.max_retries:
+                return response
+
+            # vCenter is throttling us, back off before asking again
+            response.read()
+            time.sleep(2 ** attempt + random.random())
+
+    def __send(self, soapdata, headers):
+        try:
+            self.__connection.request("POST", "/sdk", soapdata, headers)
+            return self.__connection.getresponse()
+        except ConnectionError:
+            # The server dropped the kept-alive connection, reopen it once
+            self.__keep_tls_session()
+            self.__connection.close()
+            self.__open()
+            self.__connection.request("POST", "/sdk", soapdata, headers)
+            return self.__connection.getresponse()
+
+    def __open_reply(self, response):
+        """Return the stream to read a reply body from
+
+        A gzip encoded body is unpacked while it is read. The start of the body
+        is probed for an authentication fault before anything is consumed.
+        """
+        reply = response
+        if response.getheader("Content-Encoding") == "gzip":
+            reply = gzip.GzipFile(fileobj=response, mode="rb")
+
+        head = reply.peek(512)[:512]
+        if b"NotAuthenticated" not in head:
+            return reply
+
+        # Abort the reply, the connection is reopened by the next request
+        self.__connection.close()
+        self.__check_not_authenticated(head)
+        raise TargetConnection.QueryServerException("No longer authenticated")
+
+    def __check_status(self, response):
+        """Refuse a reply without a result, a fault or throttling must not read as an empty inventory"""
+        if response.status != 200:
+            # The body is left unread, the connection is reopened by the next request
+            self.close()
+            raise TargetConnection.WebApiException("Request failed, reply %s %s" % (response.status, response.reason))
+
+    def __check_not_authenticated(self, text):
+        """Drop the stored session if the reply rejects it"""
+        if b"NotAuthenticatedFault" in text or b'<fault xsi:type="NotAuthenticated">' in text:
+            # The stored session is dead, the next run logs in again
+            self.server_cookie = None
+            if self.host_cookie_file:
+                try:
+                    os.unlink(self.host_cookie_file)
+                except FileNotFoundError:
+                    pass
 
-        return response.status, response.reason, response.msg, "".join(response_data[0].decode("utf-8"))
-    
     def login(self):
-        if not os.path.exists(self.host_cookie_path):
-            os.makedirs(self.host_cookie_path)
-        
-        if self.host_cookie_path and os.path.exists(self.host_cookie_file):
-            self.last_update = int(os.stat(self.host_cookie_file).st_mtime)
-            self.server_cookie = open(self.host_cookie_file, "r").read()
+        # Reuse the session of an earlier run if its cookie is still around
+        if self.host_cookie_file:
+            os.makedirs(self.host_cookie_path, exist_ok=True)
+            try:
+                with open(self.host_cookie_file, "r") as cookie_file:
+                    self.last_update   = int(os.fstat(cookie_file.fileno()).st_mtime)
+                    self.server_cookie = cookie_file.read()
+                return
+            except FileNotFoundError:
+                pass
+
+        payload = self.__xml_login
+        reply_code, reply_msg, reply_headers, reply_data = \
+                    self.query_target(payload, payload_params = {"username": self.encode_url(self.user),
+                                                            "password": self.encode_url(self.secret)})
+
+        if b"InvalidLogin" in reply_data:
+            self.last_update = "Cannot login to vSphere Server. Login response is not 'OK'. Please check the credentials"
         else:
-            payload = self.__xml_login
-            reply_code, reply_msg, reply_headers, reply_data = \
-                        self.query_target(payload, payload_params = {"username": self.encode_url(self.user),
-                                                                "password": self.encode_url(self.secret)})
-
-            if "InvalidLogin" in reply_data:
-                self.last_update = "Cannot login to vSphere Server. Login response is not 'OK'. Please check the credentials"
-            else:
-                self.server_cookie = reply_headers.get("Set-Cookie")
-                if self.host_cookie_file and self.server_cookie:
-                    cookie_file = open(self.host_cookie_file, "w")
-                    os.chmod(self.host_cookie_file, 600)
+            self.server_cookie = reply_headers.get("Set-Cookie")
+            if self.host_cookie_file and self.server_cookie:
+                # Created readable by the owner only, there is no window with wider permissions
+                fd = os.open(self.host_cookie_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as cookie_file:
                     cookie_file.write(self.server_cookie)
-                    cookie_file.close()
     
     def logout(self):
         try:
             self.query_target(self.__xml_logout)
-            if self.host_cookie_path and os.path.exists(self.host_cookie_file):
+            if self.host_cookie_file:
                 os.unlink(self.host_cookie_file)
         except:
             pass
@@ -391,63 +684,49 @@ class TargetConnection:
         else:
             return h.replace(" ", "_")
         
+    #
+    # Fields taken from the complex host detail properties
+    #
+    __sensor_fields         = ( "name", "label", "summary", "key", "currentReading",
+                                "unitModifier", "baseUnits", "sensorType" )
+    __hardwarestatus_fields = ( "name", "label", "summary", "key" )
+    __cpu_pkg_fields        = ( "index", "vendor", "hz", "busHz", "description" )
+    __pci_device_fields     = ( "id", "vendorName", "deviceName" )
+
     #
     # Additional values for fetching data
     #
-    __xml_systeminfo = '<ns1:RetrieveServiceContent xsi:type="ns1:RetrieveServiceContentRequestType">' \
-         '<ns1:_this type="ServiceInstance">ServiceInstance</ns1:_this></ns1:RetrieveServiceContent>'
+    __envelope_pre = b'<SOAP-ENV:Envelope xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/" '\
+           b'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ZSI="http://www.zolera.com/schemas/ZSI/" '\
+           b'xmlns:soapenc="http://schemas.xmlsoap.org/soap/encoding/" xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '\
+           b'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'\
+           b'<SOAP-ENV:Header></SOAP-ENV:Header><SOAP-ENV:Body xmlns:ns1="urn:vim25">'
+
+    __envelope_post = b'</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+    __headers = {
+        "Content-Type":    'text/xml; charset="utf-8"',
+        "SOAPAction":      "urn:vim25/5.0",
+        "User-Agent":      "Zbx-vSphere-Status",
+        "Connection":      "keep-alive",
+        # The XML replies compress several times over
+        "Accept-Encoding": "gzip",
+    }
+
+    __xml_systeminfo = string.Template('<ns1:RetrieveServiceContent xsi:type="ns1:RetrieveServiceContentRequestType">' \
+         '<ns1:_this type="ServiceInstance">ServiceInstance</ns1:_this></ns1:RetrieveServiceContent>')
     
-    __xml_continuetoken = '<ns1:ContinueRetrievePropertiesEx xsi:type="ns1:ContinueRetrievePropertiesExRequestType">' \
-         '<ns1:_this type="PropertyCollector">%(propertyCollector)s</ns1:_this><ns1:token>%(token)s</ns1:token></ns1:ContinueRetrievePropertiesEx>'
+    __xml_continuetoken = string.Template('<ns1:ContinueRetrievePropertiesEx xsi:type="ns1:ContinueRetrievePropertiesExRequestType">' \
+         '<ns1:_this type="PropertyCollector">${propertyCollector}</ns1:_this><ns1:token>${token}</ns1:token></ns1:ContinueRetrievePropertiesEx>')
 
-    __xml_login = '<ns1:Login xsi:type="ns1:LoginRequestType"><ns1:_this type="SessionManager">%(sessionManager)s</ns1:_this>' \
-         '<ns1:userName>%(username)s</ns1:userName><ns1:password>%(password)s</ns1:password></ns1:Login>'
+    __xml_login = string.Template('<ns1:Login xsi:type="ns1:LoginRequestType"><ns1:_this type="SessionManager">${sessionManager}</ns1:_this>' \
+         '<ns1:userName>${username}</ns1:userName><ns1:password>${password}</ns1:password></ns1:Login>')
 
-    __xml_logout = '<ns1:Logout xsi:type="ns1:LogoutRequestType">' \
-         '<ns1:_this type="SessionManager">%(sessionManager)s</ns1:_this></ns1:Logout>'
-    
-    __xml_hostsystems = '<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">'\
-         '<ns1:_this type="PropertyCollector">%(propertyCollector)s</ns1:_this><ns1:specSet>'\
-         '<ns1:propSet><ns1:type>HostSystem</ns1:type><ns1:pathSet>name</ns1:pathSet></ns1:propSet>'\
-         '<ns1:objectSet><ns1:obj type="Folder">%(rootFolder)s</ns1:obj><ns1:skip>false</ns1:skip>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>visitFolders</ns1:name>'\
-           '<ns1:type>Folder</ns1:type><ns1:path>childEntity</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToHf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToVmf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToH</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToDs</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>hToVm</ns1:name></ns1:selectSet>'\
-         '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToVmf</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>vmFolder</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToDs</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>datastore</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToHf</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>hostFolder</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToH</ns1:name><ns1:type>ComputeResource</ns1:type>'\
-         '<ns1:path>host</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToRp</ns1:name><ns1:type>ComputeResource</ns1:type>'\
-         '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-         '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-         '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToRp</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-           '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>hToVm</ns1:name><ns1:type>HostSystem</ns1:type>'\
-           '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToVm</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-         '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '</ns1:objectSet></ns1:specSet><ns1:options></ns1:options></ns1:RetrievePropertiesEx>'
+    __xml_logout = string.Template('<ns1:Logout xsi:type="ns1:LogoutRequestType">' \
+         '<ns1:_this type="SessionManager">${sessionManager}</ns1:_this></ns1:Logout>')
     
-    __xml_licensesused = '<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">'\
-          '<ns1:_this type="PropertyCollector">%(propertyCollector)s</ns1:_this>'\
+    __xml_licensesused = string.Template('<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">'\
+          '<ns1:_this type="PropertyCollector">${propertyCollector}</ns1:_this>'\
           '<ns1:specSet>'\
             '<ns1:propSet>'\
               '<ns1:type>LicenseManager</ns1:type>'\
@@ -455,14 +734,14 @@ class TargetConnection:
               '<ns1:pathSet>licenses</ns1:pathSet>'\
             '</ns1:propSet>'\
             '<ns1:objectSet>'\
-              '<ns1:obj type="LicenseManager">%(licenseManager)s</ns1:obj>'\
+              '<ns1:obj type="LicenseManager">${licenseManager}</ns1:obj>'\
             '</ns1:objectSet>'\
           '</ns1:specSet>'\
           '<ns1:options/>'\
-        '</ns1:RetrievePropertiesEx>'
+        '</ns1:RetrievePropertiesEx>')
     
-    __xml_datastores = '<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">'\
-         '<ns1:_this type="PropertyCollector">%(propertyCollector)s</ns1:_this><ns1:specSet>'\
+    __xml_datastores = string.Template('<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">'\
+         '<ns1:_this type="PropertyCollector">${propertyCollector}</ns1:_this><ns1:specSet>'\
          '<ns1:propSet><ns1:type>Datastore</ns1:type><ns1:pathSet>name</ns1:pathSet>'\
          '<ns1:pathSet>summary.freeSpace</ns1:pathSet>'\
          '<ns1:pathSet>summary.capacity</ns1:pathSet>'\
@@ -471,45 +750,18 @@ class TargetConnection:
          '<ns1:pathSet>summary.accessible</ns1:pathSet>'\
          '<ns1:pathSet>summary.type</ns1:pathSet>'\
          '<ns1:pathSet>summary.maintenanceMode</ns1:pathSet></ns1:propSet>'\
-         '<ns1:objectSet><ns1:obj type="Folder">%(rootFolder)s</ns1:obj><ns1:skip>false</ns1:skip>'\
+         '<ns1:objectSet><ns1:obj type="Folder">${rootFolder}</ns1:obj><ns1:skip>false</ns1:skip>'\
          '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>visitFolders</ns1:name>'\
            '<ns1:type>Folder</ns1:type><ns1:path>childEntity</ns1:path><ns1:skip>false</ns1:skip>'\
            '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToHf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToVmf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToH</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToDs</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>hToVm</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToVmf</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>vmFolder</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
+           '<ns1:selectSet><ns1:name>dcToDs</ns1:name></ns1:selectSet></ns1:selectSet>'\
          '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToDs</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>datastore</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToHf</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>hostFolder</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToH</ns1:name><ns1:type>ComputeResource</ns1:type>'\
-         '<ns1:path>host</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToRp</ns1:name><ns1:type>ComputeResource</ns1:type>'\
-           '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-         '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToRp</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-           '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>hToVm</ns1:name><ns1:type>HostSystem</ns1:type>'\
-           '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToVm</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-         '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '</ns1:objectSet></ns1:specSet><ns1:options></ns1:options></ns1:RetrievePropertiesEx>'
+           '<ns1:path>datastore</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
+         '</ns1:objectSet></ns1:specSet><ns1:options><ns1:maxObjects>${batchSize}</ns1:maxObjects></ns1:options>'\
+         '</ns1:RetrievePropertiesEx>')
     
-    __xml_hostdetails = '<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">' \
-         '<ns1:_this type="PropertyCollector">%(propertyCollector)s</ns1:_this><ns1:specSet><ns1:propSet>'\
+    __xml_hostdetails = string.Template('<ns1:RetrievePropertiesEx xsi:type="ns1:RetrievePropertiesExRequestType">' \
+         '<ns1:_this type="PropertyCollector">${propertyCollector}</ns1:_this><ns1:specSet><ns1:propSet>'\
          '<ns1:type>HostSystem</ns1:type>'\
          '<ns1:pathSet>summary.quickStats.overallMemoryUsage</ns1:pathSet>'\
          '<ns1:pathSet>hardware.cpuPkg</ns1:pathSet>'\
@@ -534,42 +786,19 @@ class TargetConnection:
          '<ns1:pathSet>runtime.healthSystemRuntime.hardwareStatusInfo.memoryStatusInfo</ns1:pathSet>'\
          '<ns1:pathSet>runtime.inMaintenanceMode</ns1:pathSet>'\
          '<ns1:pathSet>hardware.memorySize</ns1:pathSet></ns1:propSet>'\
-         '<ns1:objectSet><ns1:obj type="Folder">%(rootFolder)s</ns1:obj><ns1:skip>false</ns1:skip>'\
+         '<ns1:objectSet><ns1:obj type="Folder">${rootFolder}</ns1:obj><ns1:skip>false</ns1:skip>'\
          '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>visitFolders</ns1:name>'\
            '<ns1:type>Folder</ns1:type><ns1:path>childEntity</ns1:path><ns1:skip>false</ns1:skip>'\
            '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet>'\
            '<ns1:selectSet><ns1:name>dcToHf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToVmf</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToH</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>crToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>dcToDs</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>hToVm</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToVmf</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>vmFolder</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToDs</ns1:name><ns1:type>Datacenter</ns1:type>'\
-           '<ns1:path>datastore</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
+           '<ns1:selectSet><ns1:name>crToH</ns1:name></ns1:selectSet></ns1:selectSet>'\
          '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>dcToHf</ns1:name><ns1:type>Datacenter</ns1:type>'\
            '<ns1:path>hostFolder</ns1:path><ns1:skip>false</ns1:skip>'\
            '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
          '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToH</ns1:name><ns1:type>ComputeResource</ns1:type>'\
            '<ns1:path>host</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>crToRp</ns1:name><ns1:type>ComputeResource</ns1:type>'\
-           '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToRp</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-           '<ns1:path>resourcePool</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>rpToRp</ns1:name></ns1:selectSet>'\
-           '<ns1:selectSet><ns1:name>rpToVm</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>hToVm</ns1:name><ns1:type>HostSystem</ns1:type>'\
-           '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip>'\
-           '<ns1:selectSet><ns1:name>visitFolders</ns1:name></ns1:selectSet></ns1:selectSet>'\
-         '<ns1:selectSet xsi:type="ns1:TraversalSpec"><ns1:name>rpToVm</ns1:name><ns1:type>ResourcePool</ns1:type>'\
-           '<ns1:path>vm</ns1:path><ns1:skip>false</ns1:skip></ns1:selectSet>'\
-         '</ns1:objectSet></ns1:specSet><ns1:options></ns1:options></ns1:RetrievePropertiesEx>'
+         '</ns1:objectSet></ns1:specSet><ns1:options><ns1:maxObjects>${batchSize}</ns1:maxObjects></ns1:options>'\
+         '</ns1:RetrievePropertiesEx>')
     #
     # Exception wrapper classes
     #
@@ -589,35 +818,71 @@ class TargetConnection:
 #
 # ---------------------------------------
 
+def dump_json(data):
+    """ Serialize data to JSON encoded as UTF-8 """
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+def poll(args, target):
+    """ Collect all stats of a single target """
+    t = TargetConnection(target, user=args.user, secret=args.secret, logout=args.logout)
+    t.batch_size = args.batch_size
+    t.verbose    = args.verbose
+    t.systeminfo_cached = args.query != "about"
+    # The about information is the service content, it needs neither a session nor any inventory
+    with t:
+        if args.query == "all":
+            t.login()
+            t.retrieve_all()
+
+    return t
+
 def main(args):
     """ Main entry point of the app """
     #print(args)
 
-    try:
-        #global target_connection
-        #global target_systeminfo
-
-        t = TargetConnection(args.target, user=args.user, secret=args.secret)
-        t.connect()
-
-        # print(t.retrieve_systeminfo())
-        print(t.systeminfo)
-        t.login()
-        t.retrieve_hostsystems()
-        t.retrieve_licenses()
-        t.retrieve_datastores()
-
-        print(t.hostsystems)
-        print(t.licenses)
-        print(t.datastores)
-        print(t.hostdetails)
-
-    except:
-        raise
-    finally:
-        if args.logout:
-            t.logout()
-        t.close()
+    # Targets are polled concurrently, so their round trips overlap. A failing
+    # target is reported on its own, the others are still written out
+    failed = False
+    with ThreadPoolExecutor(max_workers=min(len(args.target), 16)) as executor:
+        polls = [ (target, executor.submit(poll, args, target)) for target in args.target ]
+        for target, future in polls:
+            try:
+                t = future.result()
+            except Exception as e:
+                sys.stderr.write("%s: %s\n" % (target, e))
+                failed = True
+                continue
+
+            if args.json:
+                stats = { "systeminfo": t.systeminfo }
+                if args.query == "all":
+                    stats.update({
+                        "hostsystems": t.hostsystems,
+                        "licenses":    t.licenses,
+                        "datastores":  t.datastores,
+                        "hostdetails": t.hostdetails,
+                    })
+                sys.stdout.buffer.write(dump_json(stats))
+                sys.stdout.buffer.write(b"\n")
+                continue
+
+            print(t.systeminfo)
+            if args.query == "about":
+                continue
+            print(t.hostsystems)
+            print(t.licenses)
+            print(t.datastores)
+
+            # The host details are the bulk of the inventory, they are only
+            # listed on request and then one host per line
+            if args.verbose > 1:
+                for name, details in t.hostdetails.items():
+                    print(name, details)
+
+    if failed:
+        sys.exit(1)
     
 
 
@@ -640,8 +905,9 @@ if __name__ == "__main__":
         "-t",
         "--target",
         type=str,
+        action="append",
         required=True,
-        help="Target address for connection")
+        help="Target address for connection, may be given multiple times")
 
     PARSER.add_argument(
         "-p",
@@ -650,6 +916,12 @@ if __name__ == "__main__":
         default=443,
         help="Target port for connection")
 
+    PARSER.add_argument(
+        "--batch-size",
+        type=int,
+        default=250,
+        help="Maximum objects per RetrievePropertiesEx page")
+
     PARSER.add_argument(
         "--timeout",
         type=int,
@@ -688,7 +960,9 @@ if __name__ == "__main__":
         "--verbose",
         action="count",
         default=0,
-        help="Verbosity (-v, -vv, etc)")
+        help="Verbosity (-v, -vv, etc)\n"
+        "-v         > paging progress on stderr\n"
+        "-vv        > also host details in plain output")
 
     # Specify output of "--version"
     PARSER.add_argument(